@@ -1,3 +1,4 @@
+import argparse
 import operator
 from collections import deque
 import logging
@@ -11,9 +12,16 @@ from scipy.ndimage import binary_fill_holes
 from skimage import io
 from skimage.measure import find_contours, label, regionprops
 from skimage.morphology import flood
-from skimage.transform import resize
-from ultralytics.engine.results import Results
-from ultralytics.models.fastsam import FastSAM, FastSAMPrompt
+from ultralytics.models.fastsam import FastSAMPrompt
+
+from dataset_store import MaskStore
+from prediction_server import LocalPredictor, PredictionClient
+from scheduling import ScheduledAction
+from session_replay import SessionRecorder
+from similarity_index import EmbeddingIndex, query_from_selection
+
+store: MaskStore | None = None
+similarity_index = EmbeddingIndex()
 
 params = Parameter.create(
     name="Options",
@@ -27,9 +35,15 @@ def opts(type: str, **kwargs):
     return dict(type=type, **kwargs)
 
 
-def register(**kwargs):
+def register(debounce=0, throttle=0, **kwargs):
+    """
+    ``debounce`` and ``throttle`` (in milliseconds) limit how often the parameter tree
+    may run the function; see ``ScheduledAction``
+    """
+
     def wrapper(func):
         func.__opts__ = kwargs
+        func.__schedule__ = dict(debounce=debounce, throttle=throttle)
         return func
 
     return wrapper
@@ -144,6 +158,13 @@ class SAMCanvas(pg.PlotWidget):
         self.image_item = pg.ImageItem(axisOrder="row-major")
         self.mask_item = ClickableImage(axisOrder="row-major")
         self.selected_region = SelectedRegion()
+        self.image_key = None
+        self.segment_embeddings = None
+        # Whether the store already holds the current labels, so saving only adds edits
+        self.labels_stored = False
+        self.similar_matches = []
+        self.scheduled_actions: dict[str, ScheduledAction] = {}
+        self.action_params: dict[str, Parameter] = {}
         for item in [self.image_item, self.mask_item, self.selected_region]:
             self.addItem(item)
         self.setAspectLocked(True)
@@ -151,7 +172,13 @@ class SAMCanvas(pg.PlotWidget):
 
         for name, func in type(self).__dict__.items():
             if hasattr(func, "__opts__"):
-                interact(getattr(self, name), **func.__opts__, parent=params)
+                action = getattr(self, name)
+                if any(func.__schedule__.values()):
+                    action = ScheduledAction(action, **func.__schedule__)
+                    self.scheduled_actions[name] = action
+                self.action_params[name] = interact(
+                    action, **func.__opts__, parent=params
+                )
 
         obj = self.selected_region
         for func in [obj.clear_mask, obj.fill_holes, obj.undo, obj.redo]:
@@ -170,17 +197,41 @@ class SAMCanvas(pg.PlotWidget):
         mask = flood(image, pos[::-1])
         self.selected_region.add_mask(mask)
 
-    def reset_image(self, image):
+    def reset_image(self, image, key=None):
+        self.image_key = key
         self.image_item.setImage(image)
-        self.run_predictor()
+        loaded = store is not None and key is not None and self.load_from_store(key)
+        if not loaded:
+            self.run_predictor()
         self.plotItem.getViewBox().autoRange()
 
+    def load_from_store(self, key):
+        if not store.has(key):
+            return False
+        label_mask = store.read(key)
+        if label_mask.shape != self.image_item.image.shape[:2]:
+            logging.warning("Stored labels for %s don't match the image; re-predicting", key)
+            return False
+        self.mask_item.setImage(label_mask)
+        if store.has(key, "annotation"):
+            self.selected_region.reset_mask(store.read(key, "annotation"))
+        else:
+            self.selected_region.reset_mask(np.zeros_like(label_mask, dtype=bool))
+        self.selected_region.clear_history()
+        self.segment_embeddings = None
+        if store.has(key, "embeddings"):
+            self.segment_embeddings = store.read(key, "embeddings")
+        self.labels_stored = True
+        return True
+
     @register(
         path=opts("file", nameFilter="Images (*.png *.jpg *.jpeg *.bmp *.tiff)"),
         runOptions=[RunOptions.ON_CHANGED, RunOptions.ON_ACTION],
+        debounce=300,
     )
     def load_local_image(self, path="flamingos.jpg"):
-        self.reset_image(io.imread(path))
+        key = None if store is None else store.key_for(path)
+        self.reset_image(io.imread(path), key)
 
     @register()
     def load_random_image(self):
@@ -190,28 +241,88 @@ class SAMCanvas(pg.PlotWidget):
         image = self.image_item.image
         if image is None:
             return
-        results: Results = model.predict(image, verbose=False)
-        assert len(results) == 1, "FastSAM only supports single-image predictions"
-        if results[0].masks is None:
+        self.labels_stored = False
+        label_mask, self.segment_embeddings = model.predict_segments(image)
+        if label_mask is None:
             self.mask_item.clear()
             return
-        combined = results[0].masks.data.argmax(axis=0)
-        foreground = combined.detach().cpu().numpy().astype(int)
-        # Since regions are selected instead of one-shot, make everything contiguous
-        label_mask = resize(foreground, image.shape[:2], order=0, anti_aliasing=False)
+        if self.image_key is not None:
+            similarity_index.add(self.image_key, self.segment_embeddings)
         self.mask_item.setImage(label_mask)
-        self.selected_region.reset_mask(np.zeros_like(label_mask))
+        self.selected_region.reset_mask(np.zeros_like(label_mask, dtype=bool))
         self.selected_region.clear_history()
 
     @register(
         colormap=opts("list", values=sorted(pg.colormap.listMaps())),
         opacity=opts("slider", limits=[0, 1], step=0.05),
         runOptions=[RunOptions.ON_CHANGED, RunOptions.ON_ACTION],
+        throttle=50,
     )
     def set_styles(self, colormap="viridis", opacity=0.5):
         colormap = pg.colormap.get(colormap)
         self.mask_item.setOpts(colorMap=colormap, opacity=opacity)
 
+    @register()
+    def save_annotation(self):
+        if store is None or self.image_key is None or self.mask_item.image is None:
+            logging.warning("Nothing to save: no dataset store or dataset image open")
+            return
+        if not self.labels_stored:
+            if self.segment_embeddings is not None:
+                embeddings = self.segment_embeddings.astype(np.float16)
+                store.write(self.image_key, "embeddings", embeddings)
+            store.write(self.image_key, "labels", self.mask_item.image)
+            self.labels_stored = True
+        store.write(self.image_key, "annotation", self.selected_region.mask)
+
+    @register(
+        threshold=opts("slider", limits=[0, 1], step=0.01),
+        top_k=opts("int", limits=[1, 1000]),
+    )
+    def select_similar(self, threshold=0.85, top_k=50):
+        label_mask = self.mask_item.image
+        selection = self.selected_region.mask
+        if (
+            label_mask is None
+            or self.segment_embeddings is None
+            or selection.shape != label_mask.shape
+            or not selection.any()
+        ):
+            logging.warning("Select an object in a predicted image first")
+            return
+        embeddings = self.segment_embeddings.astype(np.float32)
+        query = query_from_selection(embeddings, label_mask, selection)
+        similar_labels = np.flatnonzero(embeddings @ query >= threshold)
+        self.selected_region.add_mask(np.isin(label_mask, similar_labels))
+
+        if store is not None:
+            # Pick up images the pre-annotator or other annotators labeled since
+            similarity_index.sync(store)
+        self.similar_matches = similarity_index.search(
+            query, top_k, min_score=threshold, exclude_key=self.image_key
+        )
+        match_param = self.action_params["open_similar_match"].child("match")
+        match_param.setLimits(
+            {
+                f"{key} #{label} ({score:.2f})": index
+                for index, (key, label, score) in enumerate(self.similar_matches)
+            }
+        )
+        logging.info("Found %d similar objects", len(self.similar_matches))
+
+    @register(match=opts("list", limits=[]))
+    def open_similar_match(self, match=None):
+        """Open the image of a ``select_similar`` match with that object selected"""
+        if match is None or store is None or store.image_root is None:
+            logging.warning("Find similar objects in a dataset store first")
+            return
+        key, label, score = self.similar_matches[match]
+        self.load_local_image(store.image_root / key)
+        if not self.labels_stored:
+            logging.warning("Labels of %s changed since it was indexed", key)
+            return
+        self.selected_region.add_mask(self.mask_item.image == label)
+
 
 def make_window(children: list[QtWidgets.QWidget] = None):
     window = QtWidgets.QMainWindow(None)
@@ -232,11 +343,34 @@ def make_tree():
     return tree
 
 
-pg.mkQApp()
-model = FastSAM()
-canvas = SAMCanvas()
-window = make_window([canvas, make_tree()])
-canvas.load_local_image()
-canvas.run_predictor()
-window.show()
-pg.exec()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--server",
+        help="URL of a running prediction_server.py to use instead of a local model",
+    )
+    parser.add_argument(
+        "--store",
+        help="Dataset store directory to load predictions from and save annotations to",
+    )
+    parser.add_argument(
+        "--record", help="Log clicks and parameter changes here for session_replay.py"
+    )
+    parser.add_argument(
+        "--image-root",
+        help="Image directory of the dataset; only needed if the store doesn't know it",
+    )
+    args = parser.parse_args()
+
+    pg.mkQApp()
+    store = MaskStore(args.store, args.image_root) if args.store else None
+    if store is not None:
+        similarity_index = EmbeddingIndex.from_store(store)
+    model = PredictionClient(args.server) if args.server else LocalPredictor()
+    canvas = SAMCanvas()
+    window = make_window([canvas, make_tree()])
+    if args.record:
+        recorder = SessionRecorder(args.record, canvas, params)
+    canvas.load_local_image()
+    window.show()
+    pg.exec()
@@ -0,0 +1,68 @@
+"""
+Measure prediction server throughput as the number of concurrent clients grows.
+
+Start ``prediction_server.py`` first, then run e.g.
+``python bench_prediction_server.py --clients 1 2 4 8 --requests 20``.
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+from skimage import io
+
+from prediction_server import DEFAULT_URL, PredictionClient
+
+
+def run_clients(
+    url: str, image: np.ndarray, n_clients: int, n_requests: int, embeddings=False
+):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        client = PredictionClient(url)
+        predict = client.predict_segments if embeddings else client.predict_labels
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            predict(image)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.array(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--image", default="flamingos.jpg")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--requests", type=int, default=10, help="Requests sent by each client"
+    )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Also request per-segment feature vectors (labels only by default)",
+    )
+    args = parser.parse_args()
+
+    image = io.imread(args.image)
+    # Warm up the model so the first measurement doesn't include loading time
+    PredictionClient(args.url).predict_labels(image)
+
+    print(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for n_clients in args.clients:
+        total, latencies = run_clients(
+            args.url, image, n_clients, args.requests, args.embeddings
+        )
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(f"{n_clients:>7} {len(latencies) / total:>8.2f} {p50:>8.1f} {p95:>8.1f}")
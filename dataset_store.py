@@ -0,0 +1,253 @@
+"""
+On-disk store for predicted label masks and final annotations of a whole dataset.
+
+Every array is compressed into its own chunk and appended to a shard file. An
+append-only ``index.jsonl`` records where each chunk lives, so opening one image's mask
+only touches its own bytes through a memory map. Chunks are written before their index
+line, so readers never see an entry whose data is incomplete and can keep reading while
+the pre-annotator (``python dataset_store.py IMAGE_DIR STORE_DIR``) is filling the store.
+Images are keyed by their path relative to the dataset's image directory, which the
+store remembers in ``dataset.json``.
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import uuid
+import zlib
+from pathlib import Path
+
+import numpy as np
+from skimage import io
+
+INDEX_NAME = "index.jsonl"
+DATASET_NAME = "dataset.json"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tiff"}
+
+
+class MaskStore:
+    def __init__(
+        self,
+        root,
+        image_root=None,
+        max_shard_bytes=256 * 1024**2,
+        compression_level=3,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / INDEX_NAME
+        self.index_path.touch()
+        self.image_root = self._init_image_root(image_root)
+        self.max_shard_bytes = max_shard_bytes
+        self.compression_level = compression_level
+
+        self._entries: dict[tuple[str, str], dict] = {}
+        # Every entry in the order it was written, for readers that follow along
+        self._log: list[dict] = []
+        self._index_offset = 0
+        self._maps: dict[str, mmap.mmap] = {}
+        # Each writer appends to shards only it owns, so several processes can write
+        # at once without coordinating beyond single-call appends to the index
+        self._writer_id = uuid.uuid4().hex[:12]
+        self._shard_number = 0
+        self._shard_file = None
+        self.refresh()
+
+    def _init_image_root(self, image_root):
+        dataset_path = self.root / DATASET_NAME
+        stored = None
+        if dataset_path.exists():
+            stored = Path(json.loads(dataset_path.read_text())["image_root"])
+        if image_root is None:
+            return stored
+        image_root = Path(image_root).resolve()
+        if stored is not None and stored != image_root:
+            raise ValueError(f"{self.root} already holds images from {stored}")
+        if stored is None:
+            dataset_path.write_text(json.dumps(dict(image_root=str(image_root))))
+        return image_root
+
+    def key_for(self, path) -> str | None:
+        """Path relative to the dataset's image directory, or None if outside of it"""
+        if self.image_root is None:
+            return None
+        try:
+            return Path(path).resolve().relative_to(self.image_root).as_posix()
+        except ValueError:
+            return None
+
+    def refresh(self):
+        """Pick up index lines appended since the last refresh"""
+        with open(self.index_path, "rb") as index_file:
+            index_file.seek(self._index_offset)
+            data = index_file.read()
+        # A writer may be mid-line; only consume complete lines
+        complete = data[: data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            entry = json.loads(line)
+            self._entries[entry["key"], entry["kind"]] = entry
+            self._log.append(entry)
+        self._index_offset += len(complete)
+
+    def has(self, key: str, kind="labels"):
+        if (key, kind) not in self._entries:
+            self.refresh()
+        return (key, kind) in self._entries
+
+    def keys(self, kind="labels"):
+        self.refresh()
+        return sorted(key for key, entry_kind in self._entries if entry_kind == kind)
+
+    def entries_since(self, position: int, kind: str):
+        """
+        Entries of ``kind`` written after ``position`` and the position to pass next
+        time. Start from 0 to get everything.
+        """
+        self.refresh()
+        entries = [entry for entry in self._log[position:] if entry["kind"] == kind]
+        return entries, len(self._log)
+
+    def read(self, key: str, kind="labels") -> np.ndarray:
+        if not self.has(key, kind):
+            raise KeyError(f"No '{kind}' stored for {key}")
+        entry = self._entries[key, kind]
+        chunk = self._get_map(entry)[entry["offset"] : entry["offset"] + entry["length"]]
+        array = np.frombuffer(zlib.decompress(chunk), dtype=entry["dtype"])
+        return array.reshape(entry["shape"])
+
+    def write(self, key: str, kind: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        chunk = zlib.compress(array.tobytes(), self.compression_level)
+        shard_file = self._get_shard_file(len(chunk))
+        offset = shard_file.tell()
+        shard_file.write(chunk)
+        shard_file.flush()
+        entry = dict(
+            key=key,
+            kind=kind,
+            shard=Path(shard_file.name).name,
+            offset=offset,
+            length=len(chunk),
+            shape=array.shape,
+            dtype=array.dtype.str,
+        )
+        line = (json.dumps(entry) + "\n").encode()
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self._entries[key, kind] = entry
+
+    def close(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_shard_file(self, incoming_bytes: int):
+        shard_file = self._shard_file
+        if (
+            shard_file is not None
+            and shard_file.tell() + incoming_bytes > self.max_shard_bytes
+        ):
+            shard_file.close()
+            shard_file = None
+            self._shard_number += 1
+        if shard_file is None:
+            name = f"shard-{self._writer_id}-{self._shard_number:05d}.bin"
+            shard_file = self._shard_file = open(self.root / name, "ab")
+        return shard_file
+
+    def _get_map(self, entry: dict):
+        mapped = self._maps.get(entry["shard"])
+        if mapped is None or entry["offset"] + entry["length"] > len(mapped):
+            # Shards grow while being written, so remap once an entry is past the end
+            if mapped is not None:
+                mapped.close()
+            with open(self.root / entry["shard"], "rb") as shard_file:
+                mapped = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[entry["shard"]] = mapped
+        return mapped
+
+
+def _read_image(path):
+    from prediction_server import as_rgb
+
+    try:
+        return as_rgb(io.imread(path))
+    except Exception:
+        logging.exception("Skipping %s: couldn't read it as an image", path)
+        return None
+
+
+def _predict_or_skip(predictor, paths: list, images: list[np.ndarray]):
+    """
+    Predicts a batch, falling back to one image at a time if it fails, and returns
+    ``(path, output)`` for every image that could be predicted
+    """
+    try:
+        return list(zip(paths, predictor.predict_segments_batch(images)))
+    except Exception:
+        if len(images) == 1:
+            logging.exception("Skipping %s: prediction failed", paths[0])
+            return []
+        logging.exception("Batch failed; predicting its images one at a time")
+    outputs = []
+    for path, image in zip(paths, images):
+        outputs.extend(_predict_or_skip(predictor, [path], [image]))
+    return outputs
+
+
+def pre_annotate(store: MaskStore, predictor, batch_size=8):
+    if store.image_root is None:
+        raise ValueError("The store needs an image_root to know which images to label")
+    paths = [
+        path
+        for path in sorted(store.image_root.rglob("*"))
+        if path.suffix.lower() in IMAGE_EXTENSIONS and not store.has(store.key_for(path))
+    ]
+    for start in range(0, len(paths), batch_size):
+        batch_paths, images = [], []
+        for path in paths[start : start + batch_size]:
+            image = _read_image(path)
+            if image is not None:
+                batch_paths.append(path)
+                images.append(image)
+        if not images:
+            continue
+        for path, (label_mask, embeddings) in _predict_or_skip(
+            predictor, batch_paths, images
+        ):
+            if label_mask is None:
+                logging.warning("No segments found in %s", path)
+                continue
+            # Written before the labels so readers never see labels without vectors
+            key = store.key_for(path)
+            store.write(key, "embeddings", embeddings.astype(np.float16))
+            store.write(key, "labels", label_mask)
+        done = min(start + batch_size, len(paths))
+        logging.info("Pre-annotated %d/%d images", done, len(paths))
+
+
+if __name__ == "__main__":
+    from prediction_server import LocalPredictor
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("image_dir")
+    parser.add_argument("store_dir")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with MaskStore(args.store_dir, image_root=args.image_dir) as store:
+        pre_annotate(store, LocalPredictor(), args.batch_size)
@@ -0,0 +1,266 @@
+"""
+Headless prediction service that shares a single FastSAM model between annotators.
+
+Run with ``python prediction_server.py`` and point the canvas at it with
+``python 3_redo_persist.py --server http://127.0.0.1:8765``. Concurrent requests that
+arrive within ``--window`` milliseconds of each other are run through the model as one
+batch, and only a compact label mask (plus per-segment feature vectors, if asked for)
+is sent back to each client.
+"""
+
+import argparse
+import io
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from ultralytics.engine.results import Results
+from ultralytics.models.fastsam import FastSAM
+
+from similarity_index import (
+    FeatureCapture,
+    letterbox_indices,
+    pool_segment_embeddings,
+)
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+def compact_labels(label_mask: np.ndarray):
+    """Use the smallest unsigned dtype that still holds every label"""
+    max_label = int(label_mask.max()) if label_mask.size else 0
+    return label_mask.astype(np.min_scalar_type(max_label))
+
+
+def as_rgb(image: np.ndarray):
+    """
+    Converts grayscale, RGBA and 16-bit images to the 8-bit RGB the model expects.
+    Raises ``ValueError`` for anything else, e.g. 1-D or float arrays.
+    """
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    if image.dtype != np.uint8:
+        raise ValueError(f"Expected a uint8 or uint16 image, got {image.dtype}")
+    if image.ndim == 2:
+        image = image[..., None]
+    if image.ndim != 3 or image.shape[2] not in (1, 3, 4) or 0 in image.shape:
+        raise ValueError(f"Expected a gray, RGB or RGBA image, got shape {image.shape}")
+    if image.shape[2] == 1:
+        return np.repeat(image, 3, axis=2)
+    return image[..., :3]
+
+
+def labels_from_results(results: Results, shape: tuple[int, int]):
+    if results.masks is None:
+        return None
+    combined = results.masks.data.argmax(axis=0)
+    foreground = combined.detach().cpu().numpy()
+    # Masks come at the letterboxed input size. In batches of mixed image sizes that
+    # includes a lot of padding, so undo the letterbox instead of stretching the
+    # padded masks over the image
+    rows, cols = letterbox_indices(shape, foreground.shape)
+    return compact_labels(foreground[rows[:, None], cols[None, :]])
+
+
+def array_to_bytes(**arrays):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def bytes_to_arrays(data: bytes):
+    with np.load(io.BytesIO(data), allow_pickle=False) as loaded:
+        return {name: loaded[name] for name in loaded.files}
+
+
+class LocalPredictor:
+    def __init__(self, model: FastSAM = None):
+        self.model = model or FastSAM()
+
+    def predict_segments_batch(self, images: list[np.ndarray]):
+        """Returns a ``(label_mask, embeddings)`` pair per image, or Nones if empty"""
+        with FeatureCapture(self.model) as capture:
+            label_masks = self.predict_batch(images)
+        outputs = []
+        for label_mask, features in zip(label_masks, capture.features):
+            if label_mask is None:
+                outputs.append((None, None))
+                continue
+            embeddings = pool_segment_embeddings(features, label_mask, capture.stride)
+            outputs.append((label_mask, embeddings))
+        return outputs
+
+    def predict_batch(self, images: list[np.ndarray]):
+        images = [as_rgb(image) for image in images]
+        results: list[Results] = self.model.predict(images, verbose=False)
+        return [
+            labels_from_results(result, image.shape[:2])
+            for result, image in zip(results, images)
+        ]
+
+    def predict_segments(self, image: np.ndarray):
+        return self.predict_segments_batch([image])[0]
+
+
+class PredictionClient:
+    def __init__(self, url=DEFAULT_URL, timeout=60.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _predict(self, image: np.ndarray, embeddings: bool):
+        query = "?embeddings=1" if embeddings else ""
+        request = urllib.request.Request(
+            f"{self.url}/predict{query}",
+            data=array_to_bytes(image=image),
+            headers={"Content-Type": "application/octet-stream"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return bytes_to_arrays(response.read())
+
+    def predict_segments(self, image: np.ndarray):
+        arrays = self._predict(image, embeddings=True)
+        return arrays.get("labels"), arrays.get("embeddings")
+
+    def predict_labels(self, image: np.ndarray):
+        return self._predict(image, embeddings=False).get("labels")
+
+
+class MicroBatcher:
+    """
+    Collects predict requests from any number of threads and runs them through the
+    predictor in batches. A batch is closed once ``max_batch`` requests are waiting or
+    ``window`` seconds have passed since its first request arrived.
+    """
+
+    def __init__(self, predictor: LocalPredictor, window=0.01, max_batch=8):
+        self.predictor = predictor
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: queue.Queue[tuple[np.ndarray, bool, Future]] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image: np.ndarray, embeddings=False) -> Future:
+        future = Future()
+        self._queue.put((image, embeddings, future))
+        return future
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _predict(self, images: list[np.ndarray], embeddings: bool):
+        # Feature capture and pooling only pay off if someone asked for them
+        if embeddings:
+            return self.predictor.predict_segments_batch(images)
+        label_masks = self.predictor.predict_batch(images)
+        return [(label_mask, None) for label_mask in label_masks]
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            images, wants_embeddings, futures = zip(*batch)
+            try:
+                outputs = self._predict(list(images), any(wants_embeddings))
+            except Exception as ex:
+                logging.exception("Batch of %d predictions failed", len(batch))
+                if len(batch) == 1:
+                    futures[0].set_exception(ex)
+                    continue
+                # Retry one at a time so a bad request can't fail its neighbors
+                for item in batch:
+                    self._run_one(*item)
+                continue
+            for future, output in zip(futures, outputs):
+                future.set_result(output)
+
+    def _run_one(self, image: np.ndarray, embeddings: bool, future: Future):
+        try:
+            output = self._predict([image], embeddings)[0]
+        except Exception as ex:
+            logging.exception("Retried prediction failed")
+            future.set_exception(ex)
+        else:
+            future.set_result(output)
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    batcher: MicroBatcher
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/predict":
+            self.send_error(404)
+            return
+        wants_embeddings = urllib.parse.parse_qs(url.query).get("embeddings") == ["1"]
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            image = bytes_to_arrays(self.rfile.read(length))["image"]
+        except (ValueError, KeyError, OSError, EOFError):
+            self.send_error(400, "Expected an .npz payload with an 'image' array")
+            return
+        try:
+            image = as_rgb(image)
+        except ValueError as ex:
+            self.send_error(400, str(ex))
+            return
+        try:
+            future = self.batcher.submit(image, wants_embeddings)
+            label_mask, embeddings = future.result()
+        except Exception as ex:
+            self.send_error(500, str(ex))
+            return
+        arrays = {}
+        if label_mask is not None:
+            arrays["labels"] = label_mask
+            if wants_embeddings:
+                arrays["embeddings"] = embeddings.astype(np.float16)
+        body = array_to_bytes(**arrays)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(host="127.0.0.1", port=8765, window=0.01, max_batch=8):
+    batcher = MicroBatcher(LocalPredictor(), window=window, max_batch=max_batch)
+    handler = type("Handler", (PredictionHandler,), dict(batcher=batcher))
+    server = ThreadingHTTPServer((host, port), handler)
+    logging.info("Serving FastSAM predictions on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--window", type=float, default=10, help="Batching window in milliseconds"
+    )
+    parser.add_argument("--max-batch", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.host, args.port, args.window / 1000, args.max_batch)
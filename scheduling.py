@@ -0,0 +1,77 @@
+import functools
+import time
+
+from qtpy import QtCore
+
+
+class ScheduledAction:
+    """
+    Wraps a function so bursts of calls from the GUI collapse into a single run. Only
+    the arguments of the most recent call are kept; superseded calls are dropped.
+
+    - ``debounce``: run once no new call has arrived for this many milliseconds
+    - ``throttle``: run at most once per this many milliseconds. On its own, the first
+      call of a burst runs immediately and the latest one runs when the interval ends.
+      Combined with ``debounce``, runs still wait for a ``debounce`` pause, but never
+      longer than ``throttle`` after the first call they absorbed.
+    """
+
+    def __init__(self, func, debounce=0, throttle=0):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.debounce = debounce
+        self.throttle = throttle
+        self._pending = None
+        self._pending_since = None
+        self._last_run = -float("inf")
+        # Every call is numbered; callbacks get (call number, start, end) of each run
+        self.call_count = 0
+        self.run_callbacks = []
+        self._timer = QtCore.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+
+    @property
+    def pending(self):
+        return self._pending is not None
+
+    @property
+    def pending_call(self):
+        """Number of the call whose arguments will be used by the next run"""
+        return None if self._pending is None else self._pending[0]
+
+    def __call__(self, *args, **kwargs):
+        now = time.perf_counter()
+        if self._pending is None:
+            self._pending_since = now
+        self.call_count += 1
+        self._pending = (self.call_count, args, kwargs)
+        delay = self.debounce
+        if self.throttle and self.debounce:
+            waited = (now - self._pending_since) * 1000
+            delay = min(delay, max(self.throttle - waited, 0))
+        elif self.throttle:
+            elapsed = (now - self._last_run) * 1000
+            delay = max(self.throttle - elapsed, 0)
+        if delay <= 0:
+            self.flush()
+        else:
+            self._timer.start(int(delay))
+
+    def flush(self):
+        """Run the latest pending call now, if there is one"""
+        self._timer.stop()
+        if self._pending is None:
+            return None
+        call_number, args, kwargs = self._pending
+        self._pending = None
+        started = self._last_run = time.perf_counter()
+        result = self.func(*args, **kwargs)
+        finished = time.perf_counter()
+        for callback in self.run_callbacks:
+            callback(call_number, started, finished)
+        return result
+
+    def cancel(self):
+        self._timer.stop()
+        self._pending = None
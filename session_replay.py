@@ -0,0 +1,331 @@
+"""
+Record annotation sessions and replay them headlessly to measure interaction latency.
+
+Record with ``python 3_redo_persist.py --record session.jsonl``, then replay against any
+checkout of the canvas script with
+``python session_replay.py session.jsonl --build path/to/3_redo_persist.py``, passing
+the same ``--store`` and ``--image-root`` the session was recorded with. Each replayed
+event reports how long the work it caused took to finish, and ``--baseline`` turns a
+previous ``--output`` report into a pass/fail regression check.
+"""
+
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from pyqtgraph.parametertree import Parameter
+
+
+def _to_json(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class SessionRecorder:
+    """Appends canvas clicks and parameter tree changes to a JSON lines file"""
+
+    def __init__(self, path, canvas, params: Parameter):
+        self.params = params
+        self._file = open(path, "w")
+        self._start = time.perf_counter()
+        canvas.mask_item.sigClicked.connect(self.on_image_click)
+        params.sigTreeStateChanged.connect(self.on_tree_changed)
+
+    def write(self, **event):
+        event["time"] = time.perf_counter() - self._start
+        self._file.write(json.dumps(event, default=_to_json) + "\n")
+        self._file.flush()
+
+    def on_image_click(self, image, pos: tuple[int, int]):
+        self.write(type="click", pos=list(pos))
+
+    def on_tree_changed(self, root, changes):
+        for param, change, data in changes:
+            path = self.params.childPath(param)
+            if change == "value":
+                self.write(type="value", path=path, value=data)
+            elif change == "activated":
+                self.write(type="action", path=path)
+
+    def close(self):
+        self._file.close()
+
+
+def read_session(path):
+    with open(path) as session_file:
+        return [json.loads(line) for line in session_file if line.strip()]
+
+
+def load_build(script_path):
+    """Import a canvas script (e.g. ``3_redo_persist.py``) without starting its app"""
+    script_path = Path(script_path).resolve()
+    # Sibling modules (prediction server, store, ...) should come from the same build
+    sys.path.insert(0, str(script_path.parent))
+    spec = importlib.util.spec_from_file_location("sam_build", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def event_label(event: dict):
+    if event["type"] == "click":
+        return "click"
+    return f"{event['type']}:{'/'.join(event['path'])}"
+
+
+def dispatch(event: dict, canvas, params: Parameter):
+    if event["type"] == "click":
+        canvas.mask_item.sigClicked.emit(canvas.mask_item.image, tuple(event["pos"]))
+    elif event["type"] == "value":
+        params.child(*event["path"]).setValue(event["value"])
+    elif event["type"] == "action":
+        params.child(*event["path"]).activate()
+    else:
+        raise ValueError(f"Unknown event type: {event['type']}")
+
+
+class Replayer:
+    """
+    Sends events to a canvas and attributes work to the event that caused it. Work that
+    a scheduled (debounced/throttled) action runs later is charged to the event whose
+    arguments it ran with. An event is only "superseded" when a later call replaced
+    its arguments before they were used, and then it gets no latency. When events are
+    replayed at their recorded times, latency also counts how late the event could be
+    sent because earlier work was still blocking the GUI thread.
+    """
+
+    def __init__(self, app, build, canvas):
+        self.app = app
+        self.build = build
+        self.canvas = canvas
+        # Builds from before debounce/throttle existed have no scheduled actions
+        self.actions = getattr(canvas, "scheduled_actions", {})
+        self.runs: list[tuple[str, int, float, float]] = []
+        self.finished: dict[tuple[str, int], float] = {}
+        for name, action in self.actions.items():
+            action.run_callbacks.append(functools.partial(self._on_run, name))
+
+    def _on_run(self, name, call_number, started, finished):
+        self.runs.append((name, call_number, started, finished))
+        self.finished[name, call_number] = finished
+
+    def dispatch(self, label, func):
+        """
+        Runs ``func`` and returns its record, its start time and the scheduled calls it
+        queued. Only events without queued calls get their latency right away.
+        """
+        call_counts = {name: action.call_count for name, action in self.actions.items()}
+        n_runs = len(self.runs)
+        start = time.perf_counter()
+        func()
+        self.app.processEvents()
+        end = time.perf_counter()
+        # Timers of earlier events may fire while processing; that isn't our work
+        earlier_work = sum(
+            finished - started
+            for name, number, started, finished in self.runs[n_runs:]
+            if number <= call_counts[name]
+        )
+        queued = [
+            (name, action.call_count)
+            for name, action in self.actions.items()
+            if action.call_count > call_counts[name]
+            and action.pending_call == action.call_count
+        ]
+        latency = None if queued else (end - start - earlier_work) * 1000
+        return dict(label=label, latency_ms=latency), start, queued
+
+    def _call_status(self, name: str, number: int):
+        """Finish time of a queued call, "pending" while waiting, None if superseded"""
+        if (name, number) in self.finished:
+            return self.finished[name, number]
+        if self.actions[name].pending_call == number:
+            return "pending"
+        return None
+
+    def resolve(self, waiting: list):
+        """Fill in latencies of waiting events whose queued calls ran or were replaced"""
+        still_waiting = []
+        for record, start, queued in waiting:
+            statuses = [self._call_status(name, number) for name, number in queued]
+            if "pending" in statuses:
+                still_waiting.append((record, start, queued))
+                continue
+            finished = [status for status in statuses if status is not None]
+            if finished:
+                record["latency_ms"] = (max(finished) - start) * 1000
+        return still_waiting
+
+    def process_until(self, waiting: list, target=float("inf")):
+        """Process events until ``target`` passes or nothing is waiting any more"""
+        while time.perf_counter() < target and (waiting or target < float("inf")):
+            self.app.processEvents()
+            waiting = self.resolve(waiting)
+            time.sleep(0.001)
+        return self.resolve(waiting)
+
+    def timed(self, label, func):
+        record, start, queued = self.dispatch(label, func)
+        self.process_until([(record, start, queued)])
+        return record
+
+    def replay(self, events: list[dict], speed=1.0):
+        """
+        With a positive ``speed``, events are sent at their recorded times (scaled by
+        ``speed``) so debounced bursts coalesce as they did live. With ``speed=0``
+        every event is sent once the previous one's work has finished.
+        """
+        params = self.build.params
+        records = []
+        waiting = []
+        start = time.perf_counter()
+        for event in events:
+            late_ms = 0.0
+            if speed > 0:
+                target = start + event["time"] / speed
+                waiting = self.process_until(waiting, target)
+                late_ms = max(time.perf_counter() - target, 0) * 1000
+            record, event_start, queued = self.dispatch(
+                event_label(event), lambda: dispatch(event, self.canvas, params)
+            )
+            # A user would have been waiting since the input, not since we got to it
+            record["late_ms"] = late_ms
+            if record["latency_ms"] is not None:
+                record["latency_ms"] += late_ms
+            records.append(record)
+            if queued:
+                waiting.append((record, event_start - late_ms / 1000, queued))
+            if speed <= 0:
+                waiting = self.process_until(waiting)
+        self.process_until(waiting)
+        return records
+
+
+def summarize(records: list[dict]):
+    summary = {}
+    for label in sorted({record["label"] for record in records}):
+        latencies = [
+            record["latency_ms"]
+            for record in records
+            if record["label"] == label and record["latency_ms"] is not None
+        ]
+        late = [
+            record.get("late_ms", 0.0) for record in records if record["label"] == label
+        ]
+        stats = dict(
+            count=len(latencies),
+            superseded=len(late) - len(latencies),
+            p50=None,
+            p95=None,
+            max=None,
+            late_p95=float(np.percentile(late, 95)),
+        )
+        if latencies:
+            p50, p95 = np.percentile(latencies, [50, 95])
+            stats.update(p50=float(p50), p95=float(p95), max=float(max(latencies)))
+        summary[label] = stats
+    return summary
+
+
+def find_regressions(summary: dict, baseline: dict, tolerance: float, min_ms: float):
+    """Labels whose p95 latency grew by more than ``tolerance`` times the baseline"""
+    regressions = []
+    for label, stats in summary.items():
+        before = baseline.get(label, {}).get("p95")
+        after = stats["p95"]
+        if before is None or after is None:
+            continue
+        if after > before * tolerance and after - before > min_ms:
+            regressions.append((label, before, after))
+    return regressions
+
+
+def print_summary(summary: dict):
+    headers = ["n", "skipped", "p50 ms", "p95 ms", "max ms", "late p95"]
+    print(f"{'interaction':<48} " + " ".join(f"{h:>8}" for h in headers))
+    for label, stats in summary.items():
+        cells = [str(stats["count"]), str(stats["superseded"])] + [
+            "-" if stats[name] is None else f"{stats[name]:.1f}"
+            for name in ["p50", "p95", "max", "late_p95"]
+        ]
+        print(f"{label:<48} " + " ".join(f"{c:>8}" for c in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("session", help="File recorded with --record")
+    parser.add_argument("--build", default="3_redo_persist.py")
+    parser.add_argument(
+        "--server", help="Use a running prediction_server.py instead of a local model"
+    )
+    parser.add_argument(
+        "--store", help="Dataset store the session was recorded with, if any"
+    )
+    parser.add_argument(
+        "--image-root",
+        help="Image directory of the dataset; only needed if the store doesn't know it",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Playback speed relative to the recording; 0 runs events back to back",
+    )
+    parser.add_argument("--output", help="Write per-event latencies and summary here")
+    parser.add_argument("--baseline", help="Report from a previous --output to compare")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="Allowed p95 growth over the baseline before failing",
+    )
+    parser.add_argument(
+        "--min-ms",
+        type=float,
+        default=5.0,
+        help="Ignore p95 increases smaller than this, since they are mostly noise",
+    )
+    args = parser.parse_args()
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    import pyqtgraph as pg
+
+    app = pg.mkQApp()
+    build = load_build(args.build)
+    from prediction_server import LocalPredictor, PredictionClient
+
+    build.model = PredictionClient(args.server) if args.server else LocalPredictor()
+    # Loading from the store skips prediction, so replay with the same store as live
+    if args.store:
+        from dataset_store import MaskStore
+        from similarity_index import EmbeddingIndex
+
+        build.store = MaskStore(args.store, args.image_root)
+        build.similarity_index = EmbeddingIndex.from_store(build.store)
+    canvas = build.SAMCanvas()
+    window = build.make_window([canvas, build.make_tree()])
+    window.show()
+
+    replayer = Replayer(app, build, canvas)
+    startup = replayer.timed("startup", canvas.load_local_image)
+    records = [startup] + replayer.replay(read_session(args.session), args.speed)
+    summary = summarize(records)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(dict(records=records, summary=summary), output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["summary"]
+        regressions = find_regressions(summary, baseline, args.tolerance, args.min_ms)
+        for label, before, after in regressions:
+            print(f"REGRESSION {label}: p95 {before:.1f} ms -> {after:.1f} ms")
+        sys.exit(1 if regressions else 0)
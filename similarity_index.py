@@ -0,0 +1,216 @@
+"""
+Per-segment feature vectors and a dataset-wide index for "find similar objects".
+
+Each segment's vector is the area-weighted mean of the FastSAM feature map cells it
+covers, taken from the highest-resolution level that feeds the segmentation head.
+Vectors are L2-normalized, so a dot product is their cosine similarity.
+"""
+
+import numpy as np
+from ultralytics.models.fastsam import FastSAM
+
+
+class FeatureCapture:
+    """Records the finest feature map the segmentation head sees during ``predict``"""
+
+    def __init__(self, model: FastSAM):
+        self.head = model.model.model[-1]
+        self.stride = int(self.head.stride[0])
+        self.features = None
+        self._handle = None
+
+    def _hook(self, module, inputs):
+        self.features = inputs[0][0].detach().float().cpu().numpy()
+
+    def __enter__(self):
+        self.features = None
+        self._handle = self.head.register_forward_pre_hook(self._hook)
+        return self
+
+    def __exit__(self, *args):
+        self._handle.remove()
+        self._handle = None
+
+
+def letterbox_indices(shape: tuple[int, int], padded_shape: tuple[int, int], stride=1):
+    """
+    Row and column of a letterboxed array (e.g. FastSAM masks or feature maps, with
+    ``stride`` input pixels per element) that each pixel of an image with ``shape``
+    was mapped to. Mirrors ultralytics' LetterBox: uniform scale, then centered padding.
+    """
+    height, width = shape
+    padded_height, padded_width = padded_shape
+    scale = min(padded_height / height, padded_width / width)
+    new_height, new_width = round(height * scale), round(width * scale)
+    top = round((padded_height - new_height) / 2 - 0.1)
+    left = round((padded_width - new_width) / 2 - 0.1)
+    indices = []
+    for size, new_size, pad, padded_size in [
+        (height, new_height, top, padded_height),
+        (width, new_width, left, padded_width),
+    ]:
+        centers = (np.arange(size) + 0.5) * new_size / size + pad
+        n_cells = padded_size // stride
+        indices.append(np.clip((centers // stride).astype(int), 0, n_cells - 1))
+    return indices
+
+
+def pool_segment_embeddings(features: np.ndarray, label_mask: np.ndarray, stride: int):
+    """
+    ``features`` is one (channels, rows, cols) map computed on the letterboxed image.
+    Returns one normalized row per label value; labels absent from the mask are zeros.
+    """
+    channels, n_rows, n_cols = features.shape
+    padded_shape = (n_rows * stride, n_cols * stride)
+    rows, cols = letterbox_indices(label_mask.shape, padded_shape, stride)
+
+    n_cells = n_rows * n_cols
+    n_labels = int(label_mask.max()) + 1
+    cells = rows[:, None] * n_cols + cols[None, :]
+    pairs = label_mask.astype(np.int64) * n_cells + cells
+    counts = np.bincount(pairs.ravel(), minlength=n_labels * n_cells)
+    counts = counts.reshape(n_labels, n_cells).astype(np.float32)
+    embeddings = counts @ features.reshape(channels, n_cells).T
+    return normalize(embeddings)
+
+
+def normalize(vectors: np.ndarray):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def query_from_selection(
+    embeddings: np.ndarray, label_mask: np.ndarray, selection: np.ndarray
+):
+    """Average the vectors of every label under ``selection``, weighted by overlap"""
+    selected = label_mask[selection.astype(bool)]
+    counts = np.bincount(selected.ravel(), minlength=len(embeddings))
+    return normalize(counts[: len(embeddings)].astype(np.float32) @ embeddings)
+
+
+class EmbeddingIndex:
+    """
+    Normalized float32 vectors for every segment in the dataset, kept in one contiguous
+    buffer so a query is a single matrix-vector product. Each image owns one range of
+    rows. Re-adding an image marks its old range dead instead of shifting the buffer,
+    and dead rows are compacted away once they make up half of it.
+    """
+
+    def __init__(self):
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._row_images = np.zeros(0, dtype=np.int64)
+        self._row_labels = np.zeros(0, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+        self._n_dead = 0
+        self.keys: list[str] = []
+        self._key_ids: dict[str, int] = {}
+        self._ranges: dict[int, tuple[int, int]] = {}
+        self._store_position = 0
+
+    @classmethod
+    def from_store(cls, store):
+        index = cls()
+        index.sync(store)
+        return index
+
+    def sync(self, store):
+        """Add embeddings written to ``store`` since the last sync"""
+        entries, self._store_position = store.entries_since(
+            self._store_position, "embeddings"
+        )
+        # Only the newest vectors of each image matter, and ``read`` returns those
+        for key in dict.fromkeys(entry["key"] for entry in entries):
+            self.add(key, store.read(key, "embeddings"))
+
+    def __len__(self):
+        return self._size - self._n_dead
+
+    def add(self, key: str, embeddings: np.ndarray):
+        """
+        ``embeddings`` has one row per label value of ``key``'s label mask and replaces
+        any rows previously added for ``key``
+        """
+        # Labels missing from the mask have no vector and would never match
+        present = np.flatnonzero(np.abs(embeddings).sum(axis=1) > 0)
+        vectors = normalize(embeddings[present].astype(np.float32))
+
+        if key not in self._key_ids:
+            self._key_ids[key] = len(self.keys)
+            self.keys.append(key)
+        key_id = self._key_ids[key]
+        if key_id in self._ranges:
+            old_start, old_stop = self._ranges.pop(key_id)
+            self._alive[old_start:old_stop] = False
+            self._n_dead += old_stop - old_start
+
+        start, stop = self._size, self._size + len(vectors)
+        self._reserve(stop, vectors.shape[1])
+        self._vectors[start:stop] = vectors
+        self._row_images[start:stop] = key_id
+        self._row_labels[start:stop] = present
+        self._alive[start:stop] = True
+        self._ranges[key_id] = (start, stop)
+        self._size = stop
+        if self._n_dead > self._size // 2:
+            self._compact()
+
+    def _reserve(self, n_rows: int, n_dims: int):
+        capacity, dims = self._vectors.shape
+        if capacity and dims != n_dims:
+            raise ValueError(f"Expected {dims}-dimensional embeddings, got {n_dims}")
+        if n_rows <= capacity:
+            return
+        # Grow geometrically so adding images one by one stays linear overall
+        capacity = max(n_rows, 2 * capacity, 1024)
+        vectors = np.zeros((capacity, n_dims), dtype=np.float32)
+        if self._size:
+            vectors[: self._size] = self._vectors[: self._size]
+        self._vectors = vectors
+        for name in ["_row_images", "_row_labels", "_alive"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: self._size] = old[: self._size]
+            setattr(self, name, new)
+
+    def _compact(self):
+        alive = self._alive[: self._size]
+        # Alive rows keep their order, so each range just moves up by its dead rows
+        new_starts = np.concatenate([[0], np.cumsum(alive)])
+        self._ranges = {
+            key_id: (int(new_starts[start]), int(new_starts[stop]))
+            for key_id, (start, stop) in self._ranges.items()
+        }
+        n_alive = int(alive.sum())
+        for name in ["_vectors", "_row_images", "_row_labels"]:
+            array = getattr(self, name)
+            array[:n_alive] = array[: self._size][alive]
+        self._alive[: self._size] = False
+        self._alive[:n_alive] = True
+        self._size = n_alive
+        self._n_dead = 0
+
+    def search(
+        self, query: np.ndarray, top_k=20, min_score=0.0, exclude_key: str = None
+    ):
+        """Returns ``(key, label, score)`` for the best cosine matches to ``query``"""
+        if not len(self):
+            return []
+        scores = self._vectors[: self._size] @ query.astype(np.float32)
+        scores[~self._alive[: self._size]] = -np.inf
+        key_id = self._key_ids.get(exclude_key)
+        if key_id in self._ranges:
+            start, stop = self._ranges[key_id]
+            scores[start:stop] = -np.inf
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        best = best[scores[best] >= min_score]
+        return [
+            (
+                self.keys[self._row_images[row]],
+                int(self._row_labels[row]),
+                float(scores[row]),
+            )
+            for row in best
+        ]